@@ -1,16 +1,52 @@
+import argparse
+import array
+import collections
+import select
 import socket
+import struct
+import sys
+import tempfile
 import threading
+import tracemalloc
 import webbrowser
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import json
+import math
+import mimetypes
 import os
 import time
-from urllib.parse import parse_qs, urlparse
+import uuid
+from urllib.parse import parse_qs, quote, urlparse
+
+try:
+    import fcntl  # Used to read interface addresses on Unix-like systems
+except ImportError:
+    fcntl = None
 
 # Global variables
 connected_clients = []
 message_history = []
+history_offset = 0  # Message id of message_history[0] (non-zero after a reload)
+shared_files = {}  # file_id -> metadata of uploaded files
+client_last_seen = {}  # client socket -> time.monotonic() of last data received
+client_usernames = {}  # client socket -> username announced with a hello
+http_last_seen = {}  # username -> time.monotonic() of last HTTP activity
+typing_until = {}  # username -> time.monotonic() when the typing indicator expires
+presence_state = {"online": [], "typing": []}  # what clients were last told
+presence_stats = {"ticks": 0, "deltas": 0, "bytes": 0}
+connection_stats = {"accepted": 0, "closed": 0, "reaped": 0, "send_failed": 0}
 host_ip = None
+bind_addresses = []
+admin_enabled = False  # Admin/profiling endpoints, enabled with --admin
+http_in_flight = 0  # HTTP requests currently being handled
+http_in_flight_lock = threading.Lock()
+draining = threading.Event()  # Set once a successor has taken over the listeners
+handoff_path = None  # Unix socket this process listens on for --reload
+history_frozen = threading.Event()  # Set once history has been snapshotted for a successor
+handoff_done = threading.Event()  # Set once the successor has received everything
+handoff_lock = threading.Lock()  # Orders history and file registry writes against the reload snapshot
+late_uploads = []  # Uploads finished after the snapshot, waiting to be passed to the successor
+successor_conn = None  # Handoff connection kept open to pass late uploads on
 
 def get_local_ip():
     """Get the local IP address of the machine"""
@@ -22,18 +58,126 @@ def get_local_ip():
         s.close()
         return ip
     except Exception:
-        return "127.0.0.1"  # Fallback to localhost
+        # No default route (e.g. a WiFi Direct group owner), so use the
+        # first interface address before falling back to localhost
+        ips = get_local_ips()
+        return ips[0] if ips else "127.0.0.1"
+
+def get_local_ips():
+    """List the non-loopback IPv4 addresses of every local interface"""
+    ips = []
+    
+    def add(ip):
+        if ip and not ip.startswith("127.") and ip not in ips:
+            ips.append(ip)
+    
+    # Ask each interface for its address (SIOCGIFADDR) where supported
+    if fcntl is not None and hasattr(socket, "if_nameindex"):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for _, name in socket.if_nameindex():
+                try:
+                    packed = fcntl.ioctl(probe.fileno(), 0x8915, struct.pack("256s", name.encode()[:15]))
+                    add(socket.inet_ntoa(packed[20:24]))
+                except OSError:
+                    pass  # Interface has no IPv4 address
+        except OSError:
+            pass
+        finally:
+            probe.close()
+    
+    # Fall back to whatever the host name resolves to
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            add(info[4][0])
+    except OSError:
+        pass
+    
+    return ips
+
+def get_broadcast_address(ip):
+    """Directed broadcast address of the interface that owns ip, or None.
+    
+    Sending to "<broadcast>" (255.255.255.255) leaves through the
+    default route's interface whatever the socket is bound to, so each
+    interface needs its own directed broadcast address instead.
+    """
+    if fcntl is None or not hasattr(socket, "if_nameindex"):
+        return None
+    
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for _, name in socket.if_nameindex():
+            packed_name = struct.pack("256s", name.encode()[:15])
+            try:
+                # SIOCGIFADDR, then SIOCGIFBRDADDR for the matching interface
+                if socket.inet_ntoa(fcntl.ioctl(probe.fileno(), 0x8915, packed_name)[20:24]) != ip:
+                    continue
+                broadcast = socket.inet_ntoa(fcntl.ioctl(probe.fileno(), 0x8919, packed_name)[20:24])
+            except OSError:
+                continue
+            return broadcast if broadcast != "0.0.0.0" else None
+    except OSError:
+        pass
+    finally:
+        probe.close()
+    return None
+
+def get_route_ip(peer_ip):
+    """Get the local address used to reach peer_ip"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect((peer_ip, DISCOVERY_PORT))
+        return s.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        s.close()
+
+def is_wildcard_bound():
+    """Whether the servers listen on every interface"""
+    return any(address in ("", "0.0.0.0") for address in bind_addresses)
+
+def get_advertised_ips():
+    """List the addresses peers can reach the servers on"""
+    if is_wildcard_bound():
+        return get_local_ips() or [host_ip]
+    return list(bind_addresses)
 
 class ChatHandler(BaseHTTPRequestHandler):
     """HTTP handler for serving the web UI and handling API requests"""
     
-    def _set_headers(self, content_type="text/html"):
+    def setup(self):
+        # A peer that stalls mid-transfer times out instead of holding its
+        # request thread (and a half-written upload) forever
+        self.timeout = HTTP_TIMEOUT
+        super().setup()
+    
+    def handle(self):
+        global http_in_flight
+        with http_in_flight_lock:
+            http_in_flight += 1
+        try:
+            super().handle()
+        finally:
+            with http_in_flight_lock:
+                http_in_flight -= 1
+    
+    def handle_one_request(self):
+        super().handle_one_request()
+        # A replaced process finishes what it has but must not keep
+        # serving stale state on a browser's keep-alive connection
+        if draining.is_set():
+            self.close_connection = True
+    
+    def _set_headers(self, content_type="text/html", cors=True):
         self.send_response(200)
         self.send_header("Content-type", content_type)
         self.send_header("Cache-Control", "no-cache, no-store, must-revalidate")
         self.send_header("Pragma", "no-cache")
         self.send_header("Expires", "0")
-        self.send_header("Access-Control-Allow-Origin", "*")
+        if cors:
+            self.send_header("Access-Control-Allow-Origin", "*")
         self.end_headers()
     
     def _set_cors_headers(self):
@@ -44,6 +188,10 @@ class ChatHandler(BaseHTTPRequestHandler):
         self.end_headers()
     
     def do_OPTIONS(self):
+        # Never approve cross-origin requests to the admin endpoints
+        if self.path.startswith("/api/admin/"):
+            self.send_error(405, "Method not allowed")
+            return
         self._set_cors_headers()
     
     def do_GET(self):
@@ -63,12 +211,18 @@ class ChatHandler(BaseHTTPRequestHandler):
             params = parse_qs(query_params)
             last_id = int(params.get('last_id', ['-1'])[0])
             
-            # Return only new messages
-            new_messages = message_history[last_id+1:] if last_id >= -1 else message_history
+            # Polling with a username keeps an HTTP-only user online
+            if 'username' in params:
+                http_last_seen[clean_username(params['username'][0])] = time.monotonic()
+            
+            # Return only new messages; ids are absolute so they stay valid
+            # after a reload trims the history
+            start = max(last_id + 1 - history_offset, 0) if last_id >= -1 else 0
+            new_messages = message_history[start:]
             
             response = {
                 "messages": new_messages,
-                "last_id": len(message_history) - 1
+                "last_id": history_offset + len(message_history) - 1
             }
             
             self.wfile.write(json.dumps(response).encode())
@@ -76,12 +230,167 @@ class ChatHandler(BaseHTTPRequestHandler):
         # API endpoint to get server info
         elif self.path == "/api/info":
             self._set_headers("application/json")
+            # Report the address this client actually reached us on, which
+            # matters when listening on several interfaces
+            local_ip = self.connection.getsockname()[0]
             server_info = {
-                "host_ip": host_ip,
+                "host_ip": local_ip if local_ip not in ("", "0.0.0.0") else host_ip,
                 "http_port": HTTP_PORT,
                 "socket_port": SOCKET_PORT
             }
             self.wfile.write(json.dumps(server_info).encode())
+        
+        # API endpoint to get connection counters
+        elif self.path == "/api/stats":
+            self._set_headers("application/json")
+            stats = dict(connection_stats, connected=len(connected_clients))
+            stats.update({f"presence_{key}": value for key, value in presence_stats.items()})
+            self.wfile.write(json.dumps(stats).encode())
+        
+        # API endpoint to get the presence snapshot
+        elif self.path == "/api/presence":
+            self._set_headers("application/json")
+            self.wfile.write(json.dumps(presence_snapshot()).encode())
+        
+        # API endpoint to download a shared file
+        elif self.path.startswith("/api/files/"):
+            file_id = urlparse(self.path).path[len("/api/files/"):]
+            self._serve_file(file_id)
+        
+        # Admin endpoints for profiling and allocation tracing
+        elif self.path.startswith("/api/admin/"):
+            self._handle_admin()
+    
+    def _handle_admin(self):
+        """Serve the admin endpoints; hidden unless enabled and local only"""
+        if not admin_enabled:
+            self.send_error(404, "Not found")
+            return
+        if not self.client_address[0].startswith("127."):
+            self.send_error(403, "Admin endpoints are only available from localhost")
+            return
+        
+        # A web page open in a local browser can reach localhost too. It
+        # cannot add a custom header without a CORS preflight, which
+        # do_OPTIONS refuses, and a DNS-rebound page sends its own Host
+        host = (self.headers.get("Host") or "").rsplit(":", 1)[0]
+        if ADMIN_HEADER not in self.headers or host not in ("localhost", "127.0.0.1"):
+            self.send_error(403, f"Admin requests need the {ADMIN_HEADER} header")
+            return
+        
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        action = (self.command, url.path[len("/api/admin/"):])
+        
+        if action == ("GET", "profile"):
+            result = profiler.status()
+        
+        elif action == ("POST", "profile/start"):
+            try:
+                interval = float(params.get("interval", [PROFILE_INTERVAL])[0])
+                duration = float(params.get("duration", [PROFILE_MAX_DURATION])[0])
+            except ValueError:
+                interval = duration = math.nan
+            # NaN would slip past the clamps in start() and sample non-stop
+            if not (math.isfinite(interval) and math.isfinite(duration)):
+                self.send_error(400, "Invalid interval or duration")
+                return
+            started = profiler.start(interval, duration)
+            result = dict(profiler.status(), status="success" if started else "error")
+            if not started:
+                result["message"] = "Profiler already running"
+        
+        elif action == ("POST", "profile/stop"):
+            # Collapsed stacks, ready for flamegraph.pl or speedscope
+            profiler.stop()
+            self._set_headers("text/plain; charset=utf-8", cors=False)
+            self.wfile.write(profiler.collapsed().encode())
+            return
+        
+        elif action == ("POST", "tracemalloc/start"):
+            try:
+                duration = float(params.get("duration", [TRACEMALLOC_MAX_DURATION])[0])
+            except ValueError:
+                duration = math.nan
+            if not math.isfinite(duration):
+                self.send_error(400, "Invalid duration")
+                return
+            start_memory_tracing(duration)
+            result = {"status": "success", "tracing": True}
+        
+        elif action == ("GET", "tracemalloc/snapshot"):
+            if not tracemalloc.is_tracing():
+                self.send_error(409, "tracemalloc is not running")
+                return
+            result = take_memory_snapshot()
+        
+        elif action == ("POST", "tracemalloc/stop"):
+            stop_memory_tracing()
+            result = {"status": "success", "tracing": False}
+        
+        else:
+            self.send_error(404, "Not found")
+            return
+        
+        self._set_headers("application/json", cors=False)
+        self.wfile.write(json.dumps(result).encode())
+    
+    def _serve_file(self, file_id):
+        """Stream a shared file to the client, honouring a single HTTP Range"""
+        info = shared_files.get(file_id)
+        if info is None or not os.path.exists(info["path"]):
+            self.send_error(404, "File not found")
+            return
+        
+        size = info["size"]
+        start, end = 0, size - 1
+        status = 200
+        
+        range_header = self.headers.get("Range")
+        if range_header:
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+                return
+            if byte_range is not None:
+                start, end = byte_range
+                status = 206
+        
+        length = end - start + 1
+        content_type = mimetypes.guess_type(info["name"])[0] or "application/octet-stream"
+        
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Disposition", f"inline; filename*=UTF-8''{quote(info['name'])}")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        
+        if self.command == "HEAD" or length <= 0:
+            return
+        
+        # socket.sendfile() uses os.sendfile (zero-copy) where available and
+        # falls back to a small-buffer send loop elsewhere
+        with open(info["path"], "rb") as f:
+            try:
+                self.connection.sendfile(f, offset=start, count=length)
+            except (BrokenPipeError, ConnectionResetError, socket.timeout):
+                # Client went away mid-download; it can resume with a Range
+                pass
+    
+    def do_HEAD(self):
+        if self.path.startswith("/api/files/"):
+            file_id = urlparse(self.path).path[len("/api/files/"):]
+            self._serve_file(file_id)
+        else:
+            self.send_error(405, "Method not allowed")
     
     def do_POST(self):
         global message_history
@@ -93,7 +402,7 @@ class ChatHandler(BaseHTTPRequestHandler):
             
             try:
                 data = json.loads(post_data.decode())
-                username = data.get("username", "Anonymous")
+                username = clean_username(data.get("username"))
                 message = data.get("message", "")
                 
                 if message:
@@ -103,13 +412,27 @@ class ChatHandler(BaseHTTPRequestHandler):
                         "message": message,
                         "timestamp": timestamp
                     }
-                    message_history.append(new_message)
                     
-                    # Broadcast to all connected socket clients
-                    broadcast_message(json.dumps(new_message))
+                    # Once the successor has our history, storing this here
+                    # would lose it, so let the client retry there
+                    with handoff_lock:
+                        stored = not history_frozen.is_set()
+                        if stored:
+                            message_history.append(new_message)
                     
-                    self._set_headers("application/json")
-                    self.wfile.write(json.dumps({"status": "success"}).encode())
+                    if stored:
+                        # Sending counts as activity and ends the typing indicator
+                        http_last_seen[username] = time.monotonic()
+                        typing_until.pop(username, None)
+                        
+                        # Broadcast to all connected socket clients
+                        broadcast_message(json.dumps(new_message))
+                        
+                        self._set_headers("application/json")
+                        self.wfile.write(json.dumps({"status": "success"}).encode())
+                    else:
+                        self._set_headers("application/json")
+                        self.wfile.write(json.dumps({"status": "error", "message": RESTARTING_MESSAGE}).encode())
                 else:
                     self._set_headers("application/json")
                     self.wfile.write(json.dumps({"status": "error", "message": "Empty message"}).encode())
@@ -117,71 +440,1042 @@ class ChatHandler(BaseHTTPRequestHandler):
             except Exception as e:
                 self._set_headers("application/json")
                 self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
+        
+        # API endpoint to report that a user is typing
+        elif self.path == "/api/typing":
+            content_length = int(self.headers.get("Content-Length", 0))
+            
+            try:
+                data = json.loads(self.rfile.read(content_length).decode())
+                username = clean_username(data.get("username"))
+                http_last_seen[username] = time.monotonic()
+                mark_typing(username)
+                self._set_headers("application/json")
+                self.wfile.write(json.dumps({"status": "success"}).encode())
+            except Exception as e:
+                self._set_headers("application/json")
+                self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
+        
+        # API endpoint to upload a file (raw request body, streamed to disk)
+        elif self.path.startswith("/api/upload"):
+            params = parse_qs(urlparse(self.path).query)
+            username = clean_username(params.get("username", [None])[0])
+            filename = os.path.basename(params.get("filename", [""])[0]) or "file"
+            
+            try:
+                content_length = int(self.headers.get("Content-Length", ""))
+            except ValueError:
+                self._set_headers("application/json")
+                self.wfile.write(json.dumps({"status": "error", "message": "Content-Length required"}).encode())
+                return
+            
+            if content_length < 0 or content_length > MAX_UPLOAD_SIZE:
+                self._set_headers("application/json")
+                self.wfile.write(json.dumps({"status": "error", "message": "File too large"}).encode())
+                self.close_connection = True
+                return
+            
+            try:
+                file_info, entry = receive_upload(self.rfile, content_length, filename, username)
+            except Exception as e:
+                self.close_connection = True
+                self._set_headers("application/json")
+                self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
+                return
+            
+            # Announce the file by reference; the bytes stay on disk
+            new_message = {
+                "username": username,
+                "message": f"shared a file: {file_info['name']}",
+                "timestamp": time.strftime("%H:%M:%S"),
+                "file": file_info
+            }
+            publish_upload(file_info["id"], entry, new_message)
+            
+            self._set_headers("application/json")
+            self.wfile.write(json.dumps({"status": "success", "file": file_info}).encode())
+        
+        # Admin endpoints for profiling and allocation tracing
+        elif self.path.startswith("/api/admin/"):
+            self._handle_admin()
+
+def parse_range(range_header, size):
+    """Parse a single 'bytes=' Range header into an inclusive (start, end) pair.
+    
+    Returns None when the header should be ignored (malformed or multi-range)
+    and raises ValueError when the range cannot be satisfied.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    
+    first, sep, last = spec.strip().partition("-")
+    if not sep or not (first or last) or not (first == "" or first.isdigit()) or not (last == "" or last.isdigit()):
+        return None
+    
+    if first == "":
+        # Suffix range: the last N bytes
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError("Unsatisfiable range")
+        start, end = max(size - suffix, 0), size - 1
+    else:
+        start = int(first)
+        end = int(last) if last else size - 1
+        if end < start and last:
+            return None
+    
+    if start >= size:
+        raise ValueError("Unsatisfiable range")
+    return start, min(end, size - 1)
+
+def receive_upload(rfile, content_length, filename, username):
+    """Stream an upload body to disk in CHUNK_SIZE pieces.
+    
+    Returns the file info sent to clients and the registry entry for
+    shared_files; publish_upload() registers and announces the file.
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    file_id = uuid.uuid4().hex
+    path = os.path.abspath(os.path.join(UPLOAD_DIR, file_id))
+    partial_path = path + ".part"
+    
+    # Reuse one buffer so peak memory does not depend on the file size
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    remaining = content_length
+    
+    try:
+        with open(partial_path, "wb") as f:
+            while remaining > 0:
+                read = rfile.readinto(view[:min(CHUNK_SIZE, remaining)])
+                if not read:
+                    raise ConnectionError("Upload interrupted")
+                f.write(view[:read])
+                remaining -= read
+        os.replace(partial_path, path)
+    except Exception:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    
+    entry = {
+        "name": filename,
+        "size": content_length,
+        "path": path,
+        "username": username
+    }
+    
+    file_info = {
+        "id": file_id,
+        "name": filename,
+        "size": content_length,
+        "url": f"/api/files/{file_id}"
+    }
+    return file_info, entry
+
+def publish_upload(file_id, entry, message):
+    """Register an uploaded file and announce it with message.
+    
+    Once history is frozen for a reload the file belongs to the successor:
+    it is queued and passed on over the handoff connection instead, so an
+    upload that finishes while this process drains is not lost.
+    """
+    with handoff_lock:
+        if history_frozen.is_set():
+            late_uploads.append({"id": file_id, "file": entry, "message": message})
+            forward_late_uploads()
+            return
+        shared_files[file_id] = entry
+        message_history.append(message)
+    broadcast_message(json.dumps(message))
+
+def forward_late_uploads():
+    """Pass queued late uploads to the successor; call with handoff_lock held"""
+    global successor_conn
+    if successor_conn is None or not late_uploads:
+        return
+    try:
+        successor_conn.sendall(b"".join(encode_message(upload) for upload in late_uploads))
+    except OSError as e:
+        print(f"Could not pass {len(late_uploads)} uploads to the new server: {e}")
+        successor_conn.close()
+        successor_conn = None
+        return
+    late_uploads.clear()
 
 def handle_client(client_socket, addr):
     """Handle a connected client socket"""
-    global connected_clients, message_history
+    global connected_clients
     print(f"New connection from {addr}")
     
+    # Messages are newline-terminated JSON; a recv() can hold several of
+    # them, or only part of one
+    buffer = b""
+    
     try:
         while True:
-            # Receive data from client
-            data = client_socket.recv(4096)
+            # Receive data from client; the timeout lets a silent peer be
+            # noticed instead of blocking here forever
+            try:
+                data = client_socket.recv(4096)
+            except socket.timeout:
+                continue
             if not data:
                 break
             
-            # Parse the message
-            try:
-                message = json.loads(data.decode())
-                message_history.append(message)
-                
-                # Broadcast to all other clients
-                for client in connected_clients:
-                    if client != client_socket:
-                        try:
-                            client.send(data)
-                        except:
-                            pass
-            except:
-                pass
+            client_last_seen[client_socket] = time.monotonic()
+            
+            *lines, buffer = (buffer + data).split(b"\n")
+            if len(buffer) > MAX_MESSAGE_SIZE:
+                print(f"Message from {addr} exceeds {MAX_MESSAGE_SIZE} bytes; disconnecting")
+                break
+            if not all(handle_client_message(client_socket, line) for line in lines):
+                break
     
     except Exception as e:
-        print(f"Error handling client {addr}: {e}")
+        # Reaped or drained sockets are closed under us; that is not an error
+        if client_socket in connected_clients:
+            print(f"Error handling client {addr}: {e}")
     
     finally:
         # Remove the client from the list
-        if client_socket in connected_clients:
-            connected_clients.remove(client_socket)
-        client_socket.close()
+        if unregister_client(client_socket):
+            connection_stats["closed"] += 1
         print(f"Connection from {addr} closed")
 
+def handle_client_message(client_socket, line):
+    """Handle one line from a socket client; returns False to disconnect it"""
+    global message_history
+    
+    # Parse the message
+    try:
+        message = json.loads(line.decode())
+    except ValueError:
+        return True
+    
+    # Control messages (heartbeats, presence) are not chat messages
+    if isinstance(message, dict) and "type" in message:
+        handle_control_message(client_socket, message)
+        return True
+    
+    # Files are only announced by /api/upload; a socket client must not be
+    # able to point other users at arbitrary URLs
+    if isinstance(message, dict):
+        message.pop("file", None)
+    
+    # During a reload, chat stored or relayed here would never reach the
+    # successor; tell the sender and disconnect it so it reconnects to the
+    # new process and resends there
+    with handoff_lock:
+        stored = not history_frozen.is_set()
+        if stored:
+            message_history.append(message)
+    
+    if not stored:
+        try:
+            client_socket.sendall(encode_message({"type": "reconnect", "message": RESTARTING_MESSAGE}))
+        except OSError:
+            pass
+        return False
+    
+    # Broadcast to all other clients
+    payload = encode_message(message)
+    for client in connected_clients[:]:
+        if client != client_socket:
+            try:
+                client.sendall(payload)
+            except OSError:
+                if unregister_client(client):
+                    connection_stats["send_failed"] += 1
+    return True
+
+def encode_message(message):
+    """Serialize a message for the socket protocol: one JSON object per line"""
+    return json.dumps(message).encode() + b"\n"
+
 def broadcast_message(message):
     """Broadcast a message to all connected clients"""
     global connected_clients
+    payload = message.encode() + b"\n"
     for client in connected_clients[:]:  # Copy the list to avoid modification issues
         try:
-            client.send(message.encode())
-        except:
+            client.sendall(payload)
+        except OSError:
             # If sending fails, remove the client
-            if client in connected_clients:
-                connected_clients.remove(client)
+            if unregister_client(client):
+                connection_stats["send_failed"] += 1
+
+def configure_client_socket(client_socket):
+    """Apply send/receive timeouts and TCP keepalive tuning to a client socket"""
+    client_socket.settimeout(HEARTBEAT_INTERVAL)
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    
+    # Keepalive knobs are platform specific, so only set what exists
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+                          ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+                          ("TCP_USER_TIMEOUT", int(HEARTBEAT_TIMEOUT * 1000))):
+        if hasattr(socket, option):
+            try:
+                client_socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+            except OSError:
+                pass
+
+def register_client(client_socket):
+    """Track a newly accepted client socket"""
+    client_last_seen[client_socket] = time.monotonic()
+    connected_clients.append(client_socket)
+    connection_stats["accepted"] += 1
+
+def unregister_client(client_socket):
+    """Stop tracking a client socket and close it.
+    
+    Safe to call more than once; returns True only for the call that
+    actually removed the client.
+    """
+    try:
+        connected_clients.remove(client_socket)
+        removed = True
+    except ValueError:
+        removed = False
+    client_last_seen.pop(client_socket, None)
+    client_usernames.pop(client_socket, None)
+    
+    # Shutting down wakes a handle_client thread blocked in recv()
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    client_socket.close()
+    return removed
+
+def heartbeat_loop():
+    """Ping every client each interval and reap those that stopped answering"""
+    ping = encode_message({"type": "ping"})
+    
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        now = time.monotonic()
+        
+        for client in connected_clients[:]:
+            last_seen = client_last_seen.get(client, now)
+            if now - last_seen > HEARTBEAT_TIMEOUT:
+                if unregister_client(client):
+                    connection_stats["reaped"] += 1
+                continue
+            
+            try:
+                client.sendall(ping)
+            except OSError:
+                if unregister_client(client):
+                    connection_stats["send_failed"] += 1
 
-def start_socket_server():
-    """Start the socket server for real-time communication"""
-    global host_ip, connected_clients
+def clean_username(value):
+    """Turn a client-supplied username into a string usable as a presence key"""
+    if value is None or value == "":
+        return "Anonymous"
+    return str(value)
+
+def handle_control_message(client_socket, message):
+    """Handle a non-chat message from a socket client"""
+    message_type = message.get("type")
+    
+    if message_type == "hello":
+        # A client announces its username and gets the current presence
+        client_usernames[client_socket] = clean_username(message.get("username"))
+        try:
+            client_socket.sendall(encode_message(presence_snapshot()))
+        except OSError:
+            pass
+    
+    elif message_type == "typing":
+        username = client_usernames.get(client_socket)
+        if username is not None:
+            mark_typing(username)
+    
+    # Anything else (e.g. heartbeat pongs) only refreshed the last-seen time
+
+def mark_typing(username):
+    """Record that a user is typing; repeated calls just extend the deadline"""
+    typing_until[username] = time.monotonic() + TYPING_TIMEOUT
+
+def compute_presence():
+    """Work out who is online and who is typing right now"""
+    now = time.monotonic()
+    
+    # Forget HTTP-only users and typing indicators that have expired
+    for username, last_seen in list(http_last_seen.items()):
+        if now - last_seen > PRESENCE_TIMEOUT:
+            http_last_seen.pop(username, None)
+    for username, deadline in list(typing_until.items()):
+        if deadline <= now:
+            typing_until.pop(username, None)
+    
+    online = set(client_usernames.values()) | set(http_last_seen)
+    typing = set(typing_until) & online
+    return online, typing
+
+def presence_snapshot():
+    """The presence state clients were last told about"""
+    return dict(presence_state, type="presence", snapshot=True)
+
+def presence_tick():
+    """Broadcast the presence changes since the last tick as one delta.
+    
+    Joins, leaves and typing events between two ticks collapse into a single
+    message (a join followed by a leave sends nothing), so the traffic per
+    tick is one message per client however busy the room is. Deltas are
+    set operations, so applying one twice is harmless.
+    """
+    presence_stats["ticks"] += 1
     
+    online, typing = compute_presence()
+    was_online = set(presence_state["online"])
+    was_typing = set(presence_state["typing"])
+    
+    delta = {"type": "presence"}
+    for key, changed in (("joined", online - was_online),
+                         ("left", was_online - online),
+                         ("typing", typing - was_typing),
+                         ("stopped_typing", was_typing - typing)):
+        if changed:
+            delta[key] = sorted(changed)
+    if len(delta) == 1:
+        return
+    
+    # Swap in the new state before sending, so a client saying hello
+    # from here on gets a snapshot that already includes this delta
+    presence_state.update(online=sorted(online), typing=sorted(typing))
+    
+    payload = json.dumps(delta, separators=(",", ":"))
+    presence_stats["deltas"] += 1
+    presence_stats["bytes"] += (len(payload) + 1) * len(connected_clients)
+    broadcast_message(payload)
+
+def presence_loop():
+    """Run presence_tick every PRESENCE_TICK seconds"""
+    while True:
+        time.sleep(PRESENCE_TICK)
+        try:
+            presence_tick()
+        except Exception as e:
+            # One bad tick must not stop presence updates for good
+            print(f"Error updating presence: {e}")
+
+def create_listener(address, port):
+    """Create a listening TCP socket"""
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((host_ip, SOCKET_PORT))
+    server.bind((address, port))
     server.listen(10)
-    print(f"Socket server started on {host_ip}:{SOCKET_PORT}")
+    return server
+
+def start_socket_server(server):
+    """Accept socket clients for real-time communication on a listening socket"""
+    global connected_clients
     
-    while True:
-        client_socket, addr = server.accept()
-        connected_clients.append(client_socket)
-        client_thread = threading.Thread(target=handle_client, args=(client_socket, addr))
+    address, port = server.getsockname()
+    print(f"Socket server started on {address}:{port}")
+    
+    # Wake up regularly so a reload can pause or stop this loop
+    server.settimeout(1.0)
+    
+    while not handoff_done.is_set():
+        # Paused while a successor takes over; resumes if the handoff fails
+        if draining.is_set():
+            handoff_done.wait(0.1)
+            continue
+        
+        try:
+            client_socket, addr = server.accept()
+        except socket.timeout:
+            continue
+        configure_client_socket(client_socket)
+        register_client(client_socket)
+        client_thread = threading.Thread(target=handle_client, args=(client_socket, addr),
+                                         name=f"client-{addr[0]}:{addr[1]}")
         client_thread.daemon = True
         client_thread.start()
+    
+    # The successor now holds its own copy of the listening socket
+    server.close()
+
+def create_http_server(listener):
+    """Wrap an already listening socket in a threaded HTTP server"""
+    address, port = listener.getsockname()[:2]
+    # One thread per request, so a large or stalled transfer does not
+    # block chat, polling and /api/send for everyone else
+    server = ThreadingHTTPServer((address, port), ChatHandler, bind_and_activate=False)
+    server.daemon_threads = True
+    server.socket.close()
+    server.socket = listener
+    server.server_name = address
+    server.server_port = port
+    
+    # During a reload two processes accept on this socket; without this an
+    # accept that loses the race would block the loser's serve_forever()
+    listener.setblocking(False)
+    return server
+
+def serve_http(http_server):
+    """Run an HTTP server's accept loop in a background thread"""
+    http_thread = threading.Thread(target=http_server.serve_forever,
+                                   name=f"http-{http_server.server_address[0]}")
+    http_thread.daemon = True
+    http_thread.start()
+
+def get_handoff_path():
+    """Path of the reload socket for this user and these ports"""
+    return os.path.join(HANDOFF_DIR, f"{HTTP_PORT}-{SOCKET_PORT}.sock")
+
+def is_handoff_path_live(path):
+    """Whether a running server is listening on the reload socket at path"""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+
+def start_handoff_server(listeners, http_servers, takeover=False):
+    """Wait for a new process started with --reload and hand everything over.
+    
+    The listening sockets are passed with SCM_RIGHTS over a Unix socket, so
+    the kernel keeps queueing connections for them throughout the reload
+    and no client sees a refused connection. Recent history and the shared
+    file registry follow as JSON. If anything goes wrong before the
+    successor confirms, this process resumes serving and waits for the
+    next attempt.
+    
+    With takeover set (we were started with --reload) the path belongs to
+    the process we just replaced and is reclaimed without checking.
+    """
+    global handoff_path
+    
+    # Keep the socket in a private per-user directory
+    os.makedirs(HANDOFF_DIR, mode=0o700, exist_ok=True)
+    if os.stat(HANDOFF_DIR).st_uid != os.getuid():
+        print(f"Reload disabled: {HANDOFF_DIR} belongs to another user")
+        return
+    os.chmod(HANDOFF_DIR, 0o700)
+    
+    path = get_handoff_path()
+    if os.path.exists(path):
+        if not takeover and is_handoff_path_live(path):
+            print(f"Reload disabled: another server is listening on {path}")
+            return
+        os.remove(path)
+    
+    handoff = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    handoff.bind(path)
+    os.chmod(path, 0o600)
+    handoff.listen(1)
+    handoff_path = path
+    print(f"Reload handoff listening on {path}")
+    
+    while True:
+        conn, _ = handoff.accept()
+        
+        # Only a successor announces itself; liveness probes just connect
+        conn.settimeout(HANDOFF_TIMEOUT)
+        try:
+            request = conn.recv(1)
+        except OSError:
+            request = b""
+        if request != b"R":
+            conn.close()
+            continue
+        
+        print("Handing over to a new server process...")
+        try:
+            hand_over(conn, listeners, http_servers)
+            break  # conn stays open for late uploads until we exit
+        except Exception as e:
+            print(f"Handoff failed, still serving: {e}")
+            conn.close()
+            with handoff_lock:
+                history_frozen.clear()
+                resumed = late_uploads[:]
+                late_uploads.clear()
+            # Uploads that finished meanwhile are ours again
+            for upload in resumed:
+                publish_upload(upload["id"], upload["file"], upload["message"])
+            if draining.is_set():
+                draining.clear()
+                for http_server in http_servers:
+                    serve_http(http_server)
+    
+    handoff.close()  # Leave the path alone; the successor binds it next
+    handoff_done.set()
+
+def hand_over(conn, listeners, http_servers):
+    """Send the listening sockets and state to a successor over conn.
+    
+    After the successor confirms, conn is kept as successor_conn and
+    carries uploads that finish during the drain, one JSON line each.
+    """
+    global successor_conn
+    conn.settimeout(HANDOFF_TIMEOUT)
+    
+    # Send duplicates, so nothing this process closes can invalidate them
+    fds = [os.dup(listener.fileno()) for _, listener in listeners]
+    try:
+        conn.sendmsg([b"F"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds).tobytes())])
+    finally:
+        for fd in fds:
+            os.close(fd)
+    
+    # Stop accepting; new connections wait in the shared accept queue until
+    # the successor picks them up. The listeners themselves stay open until
+    # the successor confirms, so a failed handoff can resume serving.
+    draining.set()
+    for http_server in http_servers:
+        http_server.shutdown()
+    wait_for_http_requests(HANDOFF_TIMEOUT)
+    
+    # Freeze and snapshot atomically, so every message and file is either
+    # in the snapshot or rejected/queued for the successor
+    with handoff_lock:
+        history_frozen.set()
+        state = {
+            "listeners": [kind for kind, _ in listeners],
+            "history": message_history[-HANDOFF_HISTORY:],
+            "history_offset": history_offset + max(len(message_history) - HANDOFF_HISTORY, 0),
+            "files": dict(shared_files)
+        }
+    conn.sendall(json.dumps(state).encode() + b"\n")
+    
+    if conn.recv(2) != b"OK":
+        raise ConnectionError("successor did not confirm the handoff")
+    
+    # From now on uploads that finish here are passed on as they complete
+    with handoff_lock:
+        successor_conn = conn
+        forward_late_uploads()
+
+def receive_handoff():
+    """Take over the listening sockets and state of the running server.
+    
+    Raises ConnectionError if the running server sent no sockets or no
+    usable state; the running server then keeps serving.
+    """
+    global message_history, history_offset
+    
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(HANDOFF_TIMEOUT + HTTP_TIMEOUT)
+    fds = array.array("i")
+    
+    try:
+        conn.connect(get_handoff_path())
+        conn.sendall(b"R")
+        
+        _, ancdata, _, _ = conn.recvmsg(1, socket.CMSG_SPACE(MAX_HANDOFF_FDS * fds.itemsize))
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+        if not fds:
+            raise ConnectionError("no listening sockets received")
+        
+        # The state is one JSON line; nothing follows until we confirm
+        chunks = []
+        while True:
+            chunk = conn.recv(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if chunk.endswith(b"\n"):
+                break
+        
+        try:
+            state = json.loads(b"".join(chunks).decode())
+            kinds = state["listeners"]
+            history = state["history"]
+            offset = state["history_offset"]
+            files = state["files"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise ConnectionError(f"invalid handoff state: {e}")
+        if len(kinds) != len(fds):
+            raise ConnectionError(f"expected {len(kinds)} sockets, received {len(fds)}")
+        
+        listeners = [(kind, socket.socket(fileno=fd)) for kind, fd in zip(kinds, fds)]
+        conn.sendall(b"OK")
+    except Exception:
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+        raise
+    
+    message_history = history
+    history_offset = offset
+    shared_files.update(files)
+    
+    # Uploads still running in the old process arrive over conn later
+    late_thread = threading.Thread(target=receive_late_uploads, args=(conn,), name="late-uploads")
+    late_thread.daemon = True
+    late_thread.start()
+    return listeners
+
+def receive_late_uploads(conn):
+    """Register and announce uploads the old process finished after the handoff"""
+    conn.settimeout(None)
+    buffer = b""
+    try:
+        while True:
+            data = conn.recv(CHUNK_SIZE)
+            if not data:
+                break
+            *lines, buffer = (buffer + data).split(b"\n")
+            for line in lines:
+                try:
+                    upload = json.loads(line.decode())
+                    publish_upload(upload["id"], upload["file"], upload["message"])
+                except (ValueError, KeyError, TypeError) as e:
+                    print(f"Ignoring an invalid upload from the old server: {e}")
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+def wait_for_http_requests(timeout):
+    """Wait up to timeout seconds for in-flight HTTP requests to finish"""
+    deadline = time.monotonic() + timeout
+    while http_in_flight and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+def drain_clients():
+    """Close the remaining socket clients in batches spread over DRAIN_TIMEOUT.
+    
+    Closing them all at once would have every client reconnect to the new
+    process in the same instant.
+    """
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    print(f"Draining {len(connected_clients)} clients...")
+    
+    while connected_clients:
+        steps_left = max(int((deadline - time.monotonic()) / DRAIN_STEP), 1)
+        batch_size = -(-len(connected_clients) // steps_left)  # Round up
+        for client in connected_clients[:batch_size]:
+            if unregister_client(client):
+                connection_stats["closed"] += 1
+        time.sleep(DRAIN_STEP)
+
+def make_beacon(ip):
+    """Build the discovery announcement for one local address"""
+    return json.dumps({
+        "service": DISCOVERY_SERVICE,
+        "host_ip": ip,
+        "http_port": HTTP_PORT,
+        "socket_port": SOCKET_PORT
+    }, separators=(",", ":")).encode()
+
+def beacon_loop():
+    """Periodically announce the server on every usable interface"""
+    senders = {}  # local ip -> (UDP socket bound to it, beacon targets)
+    
+    while True:
+        ips = get_advertised_ips()
+        
+        # Interfaces come and go as WiFi Direct groups form, so re-check
+        for ip in list(senders):
+            if ip not in ips:
+                senders.pop(ip)[0].close()
+        
+        for ip in ips:
+            if ip not in senders:
+                try:
+                    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sender.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                    sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                    sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(ip))
+                    sender.bind((ip, 0))
+                except OSError:
+                    sender.close()
+                    continue
+                broadcast = get_broadcast_address(ip)
+                senders[ip] = (sender, [DISCOVERY_GROUP] + ([broadcast] if broadcast else []))
+            
+            sender, targets = senders[ip]
+            beacon = make_beacon(ip)
+            for target in targets:
+                try:
+                    sender.sendto(beacon, (target, DISCOVERY_PORT))
+                except OSError:
+                    pass  # e.g. no broadcast route on this interface
+        
+        time.sleep(BEACON_INTERVAL)
+
+def create_discovery_listener():
+    """Bind a UDP socket to DISCOVERY_PORT that hears broadcasts and the group"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        listener.bind(("", DISCOVERY_PORT))
+    except OSError:
+        listener.close()
+        raise
+    
+    # Join the multicast group on every interface we know about
+    for ip in ["0.0.0.0"] + get_local_ips():
+        try:
+            membership = socket.inet_aton(DISCOVERY_GROUP) + socket.inet_aton(ip)
+            listener.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError:
+            pass
+    return listener
+
+def is_beacon(message):
+    """Whether a decoded discovery datagram is a server announcement"""
+    return (isinstance(message, dict) and message.get("service") == DISCOVERY_SERVICE
+            and "type" not in message and "host_ip" in message)
+
+def discovery_responder():
+    """Answer discovery probes with a beacon for the address the prober can reach"""
+    responder = create_discovery_listener()
+    
+    print(f"Discovery responder listening on UDP port {DISCOVERY_PORT}")
+    
+    while True:
+        data, addr = responder.recvfrom(1024)
+        try:
+            message = json.loads(data.decode())
+        except ValueError:
+            continue
+        
+        # Ignore beacons (including our own) and anything else but probes
+        if not isinstance(message, dict) or message.get("type") != "probe":
+            continue
+        
+        ip = get_route_ip(addr[0])
+        if ip is None or not (is_wildcard_bound() or ip in bind_addresses):
+            continue
+        
+        try:
+            responder.sendto(make_beacon(ip), addr)
+        except OSError:
+            pass
+
+def start_discovery():
+    """Start the beacon and probe responder threads"""
+    for target, name in ((beacon_loop, "beacon"), (discovery_responder, "discovery")):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+
+def discover_servers(timeout=2.0, targets=None, limit=None):
+    """Find chat servers on the local network.
+    
+    Sends a probe to the multicast group and to the broadcast address of
+    every local interface (or to the given target addresses) and collects
+    replies for up to timeout seconds, or until limit servers have
+    answered. Without targets it also listens on DISCOVERY_PORT for the
+    servers' periodic beacons, which covers probes lost on the way.
+    Returns a list of server info dicts in the order they were heard.
+    """
+    probe = json.dumps({"type": "probe", "service": DISCOVERY_SERVICE}).encode()
+    servers = []
+    
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    sockets = [s]
+    
+    # A unicast probe to a server on this host could land on our own
+    # listener instead of the server's responder, so only listen for
+    # beacons when probing the whole network
+    if targets is None:
+        try:
+            sockets.append(create_discovery_listener())
+        except OSError:
+            pass  # Port unavailable; probe replies alone will do
+    
+    try:
+        if targets:
+            sends = [(None, target) for target in targets]
+        else:
+            sends = [(None, "<broadcast>"), (None, DISCOVERY_GROUP)]
+            for ip in get_local_ips():
+                sends.append((ip, DISCOVERY_GROUP))
+                broadcast = get_broadcast_address(ip)
+                if broadcast:
+                    sends.append((ip, broadcast))
+        
+        for ip, target in sends:
+            try:
+                if ip is not None:
+                    # Send the multicast probe out of this interface
+                    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(ip))
+                s.sendto(probe, (target, DISCOVERY_PORT))
+            except OSError:
+                pass
+        
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select(sockets, [], [], remaining)
+            for sock in readable:
+                data, _ = sock.recvfrom(1024)
+                try:
+                    server = json.loads(data.decode())
+                except ValueError:
+                    continue
+                if is_beacon(server) and server not in servers:
+                    servers.append(server)
+            if limit and len(servers) >= limit:
+                servers = servers[:limit]
+                break
+    finally:
+        for sock in sockets:
+            sock.close()
+    
+    return servers
+
+class SamplingProfiler:
+    """Sampling profiler that records the collapsed stacks of every thread.
+    
+    A background thread wakes every interval, grabs sys._current_frames()
+    and counts each stack as "thread;outer;...;inner". Nothing is hooked
+    into the profiled code, so the cost is bounded by the sampling rate.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.interval = None
+        self.started_at = None
+    
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+    
+    def start(self, interval, duration):
+        """Start sampling; returns False if a run is already in progress"""
+        with self.lock:
+            if self.running():
+                return False
+            self.interval = max(interval, PROFILE_MIN_INTERVAL)
+            duration = min(max(duration, 0), PROFILE_MAX_DURATION)
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self.started_at = time.monotonic()
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, args=(self.started_at + duration,), name="profiler")
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+    
+    def stop(self):
+        """Stop sampling, keeping the collected stacks"""
+        self.stop_event.set()
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+    
+    def status(self):
+        return {
+            "running": self.running(),
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+            "interval": self.interval
+        }
+    
+    def collapsed(self):
+        """Return the stacks in collapsed format, one "stack count" per line"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+    
+    def _run(self, deadline):
+        own_ident = threading.get_ident()
+        while not self.stop_event.wait(self.interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                key = ";".join(reversed(stack))
+                
+                # Cap memory use on pathological workloads
+                if key not in self.stacks and len(self.stacks) >= PROFILE_MAX_STACKS:
+                    key = "[truncated]"
+                self.stacks[key] += 1
+            self.samples += 1
+
+profiler = SamplingProfiler()
+last_memory_snapshot = None
+memory_tracing_timer = None  # Stops tracemalloc once its duration is up
+
+def start_memory_tracing(duration):
+    """Start tracemalloc for at most TRACEMALLOC_MAX_DURATION seconds"""
+    global memory_tracing_timer
+    
+    if memory_tracing_timer is not None:
+        memory_tracing_timer.cancel()
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    
+    # Tracing slows every allocation, so it never outlives its deadline
+    duration = min(max(duration, 0), TRACEMALLOC_MAX_DURATION)
+    memory_tracing_timer = threading.Timer(duration, stop_memory_tracing)
+    memory_tracing_timer.name = "tracemalloc-timer"
+    memory_tracing_timer.daemon = True
+    memory_tracing_timer.start()
+
+def take_memory_snapshot():
+    """Take a tracemalloc snapshot and diff it against the previous one"""
+    global last_memory_snapshot
+    
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    
+    result = {
+        "traced_current": current,
+        "traced_peak": peak,
+        "message_history": len(message_history),
+        "connected_clients": len(connected_clients),
+        "shared_files": len(shared_files),
+        "top": [
+            {"where": str(stat.traceback), "size": stat.size, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]
+        ],
+        "diff": []
+    }
+    
+    if last_memory_snapshot is not None:
+        result["diff"] = [
+            {"where": str(stat.traceback), "size_diff": stat.size_diff, "size": stat.size,
+             "count_diff": stat.count_diff}
+            for stat in snapshot.compare_to(last_memory_snapshot, "lineno")[:TRACEMALLOC_TOP]
+        ]
+    
+    # Only the latest snapshot is kept, so repeated calls do not pile up
+    last_memory_snapshot = snapshot
+    return result
+
+def stop_memory_tracing():
+    """Stop tracemalloc and drop the stored snapshot"""
+    global last_memory_snapshot, memory_tracing_timer
+    if memory_tracing_timer is not None:
+        memory_tracing_timer.cancel()
+        memory_tracing_timer = None
+    last_memory_snapshot = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
 
 # Define the HTML content with embedded CSS and JavaScript
 HTML_CONTENT = """<!DOCTYPE html>
@@ -362,6 +1656,23 @@ HTML_CONTENT = """<!DOCTYPE html>
             flex-grow: 1;
         }
         
+        .file-input {
+            display: none;
+        }
+        
+        .message-file a {
+            color: var(--accent-color);
+            word-break: break-all;
+        }
+        
+        .message-file img {
+            display: block;
+            max-width: 100%;
+            max-height: 240px;
+            margin-top: 6px;
+            border-radius: 10px;
+        }
+        
         /* Connection status indicator */
         .status-indicator {
             display: inline-block;
@@ -423,6 +1734,25 @@ HTML_CONTENT = """<!DOCTYPE html>
             text-align: center;
         }
         
+        /* Presence and typing indicators */
+        .presence {
+            font-size: 0.85rem;
+            opacity: 0.8;
+            padding: 0.4rem 0.8rem;
+            background-color: rgba(32, 54, 71, 0.4);
+            white-space: nowrap;
+            overflow: hidden;
+            text-overflow: ellipsis;
+        }
+        
+        .typing-indicator {
+            font-size: 0.8rem;
+            font-style: italic;
+            opacity: 0.7;
+            padding: 0 1rem;
+            min-height: 1.2rem;
+        }
+        
         /* Responsiveness */
         @media (max-width: 600px) {
             .message {
@@ -456,6 +1786,8 @@ HTML_CONTENT = """<!DOCTYPE html>
             <button id="setUsername">Set Name</button>
         </div>
         
+        <div class="presence" id="presenceInfo">Online: nobody yet</div>
+        
         <div class="chat-container">
             <div class="messages" id="messagesContainer">
                 <div class="loading">
@@ -467,8 +1799,12 @@ HTML_CONTENT = """<!DOCTYPE html>
                 </div>
             </div>
             
+            <div class="typing-indicator" id="typingIndicator"></div>
+            
             <div class="input-area">
                 <input type="text" id="messageInput" class="message-input" placeholder="Type your message..." disabled>
+                <input type="file" id="fileInput" class="file-input">
+                <button id="attachButton" title="Share a file" disabled>&#128206;</button>
                 <button id="sendButton" disabled>Send</button>
             </div>
         </div>
@@ -482,15 +1818,26 @@ HTML_CONTENT = """<!DOCTYPE html>
         let lastMessageId = -1;
         let isInitialLoad = true;
         let pollingTimeoutId = null;
+        let onlineUsers = new Set();
+        let typingUsers = new Set();
+        let lastTypingSent = 0;
+        const TYPING_DEBOUNCE = 2000;  // ms between typing notifications
+        let reconnectAttempts = 0;
+        const RECONNECT_BASE_DELAY = 1000;  // ms before the first reconnect attempt
+        const RECONNECT_MAX_DELAY = 30000;  // ms cap on the reconnect delay
         
         // DOM Elements
         const messagesContainer = document.getElementById('messagesContainer');
         const messageInput = document.getElementById('messageInput');
         const sendButton = document.getElementById('sendButton');
+        const fileInput = document.getElementById('fileInput');
+        const attachButton = document.getElementById('attachButton');
         const usernameInput = document.getElementById('usernameInput');
         const setUsernameButton = document.getElementById('setUsername');
         const serverInfoEl = document.getElementById('serverInfo');
         const connectionStatusEl = document.getElementById('connectionStatus');
+        const presenceInfoEl = document.getElementById('presenceInfo');
+        const typingIndicatorEl = document.getElementById('typingIndicator');
         
         // Set username
         setUsernameButton.addEventListener('click', () => {
@@ -499,11 +1846,13 @@ HTML_CONTENT = """<!DOCTYPE html>
                 username = newUsername;
                 messageInput.disabled = false;
                 sendButton.disabled = false;
+                attachButton.disabled = false;
                 usernameInput.disabled = true;
                 setUsernameButton.disabled = true;
                 
                 // Add a system message
                 addSystemMessage(`You joined as "${username}"`);
+                sendHello();
                 messageInput.focus();
             }
         });
@@ -528,6 +1877,8 @@ HTML_CONTENT = """<!DOCTYPE html>
                     if (data.status === 'success') {
                         messageInput.value = '';
                         messageInput.focus();
+                    } else {
+                        addSystemMessage(data.message);
                     }
                 })
                 .catch(error => {
@@ -547,6 +1898,120 @@ HTML_CONTENT = """<!DOCTYPE html>
             }
         });
         
+        // Tell the server we are typing, at most once per TYPING_DEBOUNCE;
+        // the server expires the indicator on its own
+        messageInput.addEventListener('input', () => {
+            const now = Date.now();
+            if (!messageInput.value || now - lastTypingSent < TYPING_DEBOUNCE) {
+                return;
+            }
+            lastTypingSent = now;
+            
+            if (isSocketConnected) {
+                sendSocketMessage({ type: 'typing' });
+            } else {
+                fetch('/api/typing', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify({ username: username })
+                }).catch(error => console.error('Error sending typing status:', error));
+            }
+        });
+        
+        // Announce our username over the socket to appear online
+        function sendHello() {
+            // Only once a name has been set and the socket is up
+            if (isSocketConnected && usernameInput.disabled) {
+                sendSocketMessage({ type: 'hello', username: username });
+            }
+        }
+        
+        // Apply a presence snapshot or delta from the server
+        function applyPresence(update) {
+            if (update.snapshot) {
+                onlineUsers = new Set(update.online);
+                typingUsers = new Set(update.typing);
+            } else {
+                (update.joined || []).forEach(user => onlineUsers.add(user));
+                (update.left || []).forEach(user => {
+                    onlineUsers.delete(user);
+                    typingUsers.delete(user);
+                });
+                (update.typing || []).forEach(user => typingUsers.add(user));
+                (update.stopped_typing || []).forEach(user => typingUsers.delete(user));
+            }
+            renderPresence();
+        }
+        
+        // Show who is online and who is typing
+        function renderPresence() {
+            const online = [...onlineUsers].sort();
+            presenceInfoEl.textContent = online.length ? `Online (${online.length}): ${online.join(', ')}` : 'Online: nobody yet';
+            
+            const typing = [...typingUsers].filter(user => user !== username);
+            if (typing.length === 0) {
+                typingIndicatorEl.textContent = '';
+            } else if (typing.length <= 3) {
+                typingIndicatorEl.textContent = `${typing.join(', ')} ${typing.length === 1 ? 'is' : 'are'} typing...`;
+            } else {
+                typingIndicatorEl.textContent = 'Several people are typing...';
+            }
+        }
+        
+        // Fetch the presence snapshot (used while the socket is down)
+        function fetchPresence() {
+            fetch('/api/presence')
+                .then(response => response.json())
+                .then(applyPresence)
+                .catch(error => console.error('Error fetching presence:', error));
+        }
+        
+        // Share a file: the raw file is streamed as the request body and
+        // the server announces it to everyone as a chat message
+        attachButton.addEventListener('click', () => fileInput.click());
+        
+        fileInput.addEventListener('change', () => {
+            const file = fileInput.files[0];
+            if (!file) {
+                return;
+            }
+            
+            addSystemMessage(`Uploading "${file.name}"...`);
+            fetch(`/api/upload?filename=${encodeURIComponent(file.name)}&username=${encodeURIComponent(username)}`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/octet-stream',
+                },
+                body: file
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.status !== 'success') {
+                    addSystemMessage(`Upload failed: ${data.message}`);
+                }
+            })
+            .catch(error => {
+                console.error('Error uploading file:', error);
+                addSystemMessage('Failed to upload file. Please try again.');
+            })
+            .finally(() => {
+                fileInput.value = '';
+            });
+        });
+        
+        // Format a byte count for display
+        function formatSize(bytes) {
+            const units = ['B', 'KB', 'MB', 'GB'];
+            let i = 0;
+            while (bytes >= 1024 && i < units.length - 1) {
+                bytes /= 1024;
+                i++;
+            }
+            return `${bytes.toFixed(i ? 1 : 0)} ${units[i]}`;
+        }
+        
         // Add a message to the chat
         function addMessage(message) {
             const isOwnMessage = message.username === username;
@@ -572,6 +2037,31 @@ HTML_CONTENT = """<!DOCTYPE html>
             contentEl.className = 'message-content';
             contentEl.textContent = message.message;
             
+            if (message.file && typeof message.file.id === 'string') {
+                contentEl.textContent = '';
+                contentEl.classList.add('message-file');
+                
+                // Build the link from the id, never from a URL in the message
+                const url = `/api/files/${encodeURIComponent(message.file.id)}`;
+                const name = String(message.file.name);
+                const size = Number.isFinite(message.file.size) ? ` (${formatSize(message.file.size)})` : '';
+                
+                const linkEl = document.createElement('a');
+                linkEl.href = url;
+                linkEl.target = '_blank';
+                linkEl.download = name;
+                linkEl.textContent = `${name}${size}`;
+                contentEl.appendChild(linkEl);
+                
+                if (/\\.(png|jpe?g|gif|webp|bmp)$/i.test(name)) {
+                    const imgEl = document.createElement('img');
+                    imgEl.src = url;
+                    imgEl.alt = name;
+                    imgEl.loading = 'lazy';
+                    contentEl.appendChild(imgEl);
+                }
+            }
+            
             messageEl.appendChild(headerEl);
             messageEl.appendChild(contentEl);
             
@@ -606,17 +2096,19 @@ HTML_CONTENT = """<!DOCTYPE html>
                 socket.onopen = () => {
                     console.log('WebSocket connected');
                     isSocketConnected = true;
+                    reconnectAttempts = 0;
                     updateConnectionStatus(true);
                     addSystemMessage('Connected to chat server');
+                    sendHello();
                 };
                 
+                // The server sends one JSON message per line, and a chunk
+                // may hold several lines or end part-way through one
+                let receiveBuffer = '';
                 socket.onmessage = (event) => {
-                    try {
-                        const message = JSON.parse(event.data);
-                        addMessage(message);
-                    } catch (e) {
-                        console.error('Error parsing message:', e);
-                    }
+                    const lines = (receiveBuffer + event.data).split('\\n');
+                    receiveBuffer = lines.pop();
+                    lines.filter(line => line.trim()).forEach(handleSocketMessage);
                 };
                 
                 socket.onclose = () => {
@@ -629,7 +2121,7 @@ HTML_CONTENT = """<!DOCTYPE html>
                         if (!isSocketConnected) {
                             connectWebSocket(host, port);
                         }
-                    }, 5000);
+                    }, reconnectDelay());
                 };
                 
                 socket.onerror = (error) => {
@@ -644,6 +2136,46 @@ HTML_CONTENT = """<!DOCTYPE html>
             }
         }
         
+        // Handle one message line from the chat server
+        function handleSocketMessage(line) {
+            try {
+                const message = JSON.parse(line);
+                
+                // Answer heartbeats so the server keeps us registered
+                if (message.type === 'ping') {
+                    sendSocketMessage({ type: 'pong' });
+                    return;
+                }
+                
+                if (message.type === 'presence') {
+                    applyPresence(message);
+                    return;
+                }
+                
+                // The server is being replaced and will close us
+                if (message.type === 'reconnect') {
+                    return;
+                }
+                
+                addMessage(message);
+            } catch (e) {
+                console.error('Error parsing message:', e);
+            }
+        }
+        
+        // Send a message to the chat server, newline-terminated like the replies
+        function sendSocketMessage(message) {
+            socket.send(JSON.stringify(message) + '\\n');
+        }
+        
+        // Exponential backoff with full jitter, so clients dropped together
+        // (e.g. by a server reload) do not all reconnect at the same moment
+        function reconnectDelay() {
+            const maxDelay = Math.min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** reconnectAttempts);
+            reconnectAttempts++;
+            return Math.random() * maxDelay;
+        }
+        
         // Update connection status indicator
         function updateConnectionStatus(connected) {
             if (connected) {
@@ -690,9 +2222,15 @@ HTML_CONTENT = """<!DOCTYPE html>
                 `;
             }
             
-            fetch(`/api/messages?last_id=${lastMessageId}`)
+            const userParam = usernameInput.disabled ? `&username=${encodeURIComponent(username)}` : '';
+            fetch(`/api/messages?last_id=${lastMessageId}${userParam}`)
                 .then(response => response.json())
                 .then(data => {
+                    // Without the socket, presence comes from the snapshot endpoint
+                    if (!isSocketConnected) {
+                        fetchPresence();
+                    }
+                    
                     // Clear the loading indicator on first load
                     if (isInitialLoad) {
                         messagesContainer.innerHTML = '';
@@ -702,7 +2240,13 @@ HTML_CONTENT = """<!DOCTYPE html>
                     // Add new messages
                     if (data.messages && data.messages.length) {
                         data.messages.forEach(message => {
-                            addMessage(message);
+                            // One bad message must not stop lastMessageId
+                            // from advancing, or every poll would repeat it
+                            try {
+                                addMessage(message);
+                            } catch (e) {
+                                console.error('Error rendering message:', e);
+                            }
                         });
                         
                         // Update last message ID
@@ -757,31 +2301,157 @@ HTML_CONTENT = """<!DOCTYPE html>
 # Configuration
 HTTP_PORT = 8000  # HTTP server port
 SOCKET_PORT = 9000  # Socket server port
+UPLOAD_DIR = "uploads"  # Where shared files are stored
+CHUNK_SIZE = 64 * 1024  # Upload streaming chunk size in bytes
+MAX_UPLOAD_SIZE = 2 * 1024 * 1024 * 1024  # Largest accepted upload (2 GiB)
+HTTP_TIMEOUT = 30  # Seconds an HTTP peer may stall before its request is dropped
+HEARTBEAT_INTERVAL = 10  # Seconds between heartbeat pings (also the socket timeout)
+HEARTBEAT_TIMEOUT = 30  # Seconds of silence before a client is reaped
+KEEPALIVE_IDLE = 30  # TCP keepalive: idle seconds before the first probe
+KEEPALIVE_INTERVAL = 10  # TCP keepalive: seconds between probes
+KEEPALIVE_COUNT = 3  # TCP keepalive: unanswered probes before the kernel drops it
+MAX_MESSAGE_SIZE = 64 * 1024  # Longest socket message line accepted from a client
+
+DISCOVERY_PORT = 9999  # UDP port for discovery beacons and probes
+DISCOVERY_GROUP = "239.255.77.77"  # Multicast group for discovery
+DISCOVERY_SERVICE = "wifi-direct-chat"  # Service name carried in beacons
+BEACON_INTERVAL = 2  # Seconds between discovery beacons
+BIND_ADDRESSES = ["0.0.0.0"]  # Addresses to listen on; 0.0.0.0 means every interface
+PRESENCE_TICK = 1  # Seconds between coalesced presence updates
+PRESENCE_TIMEOUT = 60  # Seconds an HTTP-only user stays online after their last request
+TYPING_TIMEOUT = 4  # Seconds a typing indicator lasts without another keystroke
+PROFILE_INTERVAL = 0.01  # Default seconds between profiler samples
+PROFILE_MIN_INTERVAL = 0.005  # Fastest sampling rate allowed, to bound overhead
+PROFILE_MAX_DURATION = 60  # Profiler stops itself after this many seconds
+PROFILE_MAX_STACKS = 5000  # Distinct stacks kept; the rest are counted as truncated
+TRACEMALLOC_FRAMES = 1  # Frames recorded per allocation (more is slower)
+TRACEMALLOC_TOP = 25  # Entries returned per snapshot and diff
+ADMIN_HEADER = "X-Admin-Request"  # Header every admin request must carry
+TRACEMALLOC_MAX_DURATION = 300  # tracemalloc stops itself after this many seconds
+HANDOFF_DIR = os.path.join(tempfile.gettempdir(), f"wifi-direct-chat-{os.getuid() if hasattr(os, 'getuid') else 'user'}")  # Per-user directory for reload sockets
+HANDOFF_HISTORY = 500  # Most recent messages passed to the new process on reload
+MAX_HANDOFF_FDS = 64  # Most listening sockets a reload can pass over
+HANDOFF_TIMEOUT = 5  # Seconds a reload may take before the old process gives up and keeps serving
+RESTARTING_MESSAGE = "Server is restarting; please resend"  # Sent for chat rejected during a reload
+DRAIN_TIMEOUT = 10  # Seconds the old process takes to close its clients after a reload
+DRAIN_STEP = 0.5  # Seconds between batches of closed clients while draining
+DRAIN_UPLOAD_TIMEOUT = 600  # Seconds a replaced process keeps running for unfinished uploads
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="WiFi Direct Chat Server")
+    parser.add_argument("--bind", action="append", metavar="ADDRESS",
+                        help="address to listen on (repeatable, default: all interfaces)")
+    parser.add_argument("--discover", action="store_true",
+                        help="look for chat servers on the local network and exit")
+    parser.add_argument("--admin", action="store_true",
+                        help="enable the localhost-only profiling endpoints under /api/admin/")
+    parser.add_argument("--reload", action="store_true",
+                        help="take over the listening sockets and history of the running server")
+    return parser.parse_args()
 
 def main():
-    global host_ip
+    global host_ip, bind_addresses, admin_enabled
+    
+    args = parse_args()
+    admin_enabled = args.admin
+    
+    if args.discover:
+        servers = discover_servers()
+        if not servers:
+            print("No chat servers found")
+        for server in servers:
+            print(f"Found server at http://{server['host_ip']}:{server['http_port']} "
+                  f"(socket port {server['socket_port']})")
+        return
     
     # Get the local IP address
     host_ip = get_local_ip()
+    
+    # Listening sockets as (kind, socket) pairs, kept so a reload can pass them on
+    listeners = []
+    if args.reload:
+        if not hasattr(socket, "AF_UNIX") or not os.path.exists(get_handoff_path()):
+            print("No running server to take over")
+            return
+        try:
+            listeners = receive_handoff()
+        except (OSError, ConnectionError) as e:
+            print(f"Could not take over the running server: {e}")
+            return
+        print(f"Took over {len(listeners)} listening sockets and {len(message_history)} messages")
+    
+    bind_addresses = args.bind or [listener.getsockname()[0] for kind, listener in listeners if kind == "http"] or BIND_ADDRESSES
+    if not is_wildcard_bound() and host_ip not in bind_addresses:
+        host_ip = bind_addresses[0]
     print(f"Starting WiFi Direct Chat Server on {host_ip}")
     
-    # Start the socket server in a separate thread
-    socket_thread = threading.Thread(target=start_socket_server)
-    socket_thread.daemon = True
-    socket_thread.start()
+    if not listeners:
+        for address in bind_addresses:
+            listeners.append(("socket", create_listener(address, SOCKET_PORT)))
+            listeners.append(("http", create_listener(address, HTTP_PORT)))
+    
+    # Start a socket server and an HTTP server for every bind address
+    http_servers = []
+    for kind, listener in listeners:
+        address = listener.getsockname()[0]
+        if kind == "socket":
+            socket_thread = threading.Thread(target=start_socket_server, args=(listener,),
+                                             name=f"socket-server-{address}")
+            socket_thread.daemon = True
+            socket_thread.start()
+        else:
+            http_servers.append(create_http_server(listener))
+            print(f"HTTP server started on http://{address}:{listener.getsockname()[1]}")
+    
+    heartbeat_thread = threading.Thread(target=heartbeat_loop, name="heartbeat")
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
     
-    # Start the HTTP server
-    http_server = HTTPServer((host_ip, HTTP_PORT), ChatHandler)
-    print(f"HTTP server started on http://{host_ip}:{HTTP_PORT}")
+    presence_thread = threading.Thread(target=presence_loop, name="presence")
+    presence_thread.daemon = True
+    presence_thread.start()
     
-    # Open the browser
-    webbrowser.open(f"http://{host_ip}:{HTTP_PORT}")
+    # Announce ourselves so peers do not need to be told the IP
+    start_discovery()
     
+    # Let a future `--reload` take over from us
+    if hasattr(socket, "AF_UNIX") and hasattr(socket.socket, "sendmsg"):
+        handoff_thread = threading.Thread(target=start_handoff_server, args=(listeners, http_servers, args.reload),
+                                          name="handoff")
+        handoff_thread.daemon = True
+        handoff_thread.start()
+    
+    for http_server in http_servers:
+        serve_http(http_server)
+    
+    # Open the browser (a reload keeps the tabs that are already open)
+    if not args.reload:
+        webbrowser.open(f"http://{host_ip}:{HTTP_PORT}")
+    
+    # Serve until interrupted or until a successor has taken over
     try:
-        http_server.serve_forever()
+        while not handoff_done.wait(1):
+            pass
     except KeyboardInterrupt:
         print("Server shutting down...")
+        for http_server in http_servers:
+            http_server.server_close()
+        if not draining.is_set() and handoff_path and os.path.exists(handoff_path):
+            os.remove(handoff_path)
+        return
+    
+    for http_server in http_servers:
         http_server.server_close()
+    drain_clients()
+    
+    # Request threads are daemons, so let in-flight transfers finish first;
+    # uploads that complete now are passed to the successor
+    wait_for_http_requests(DRAIN_UPLOAD_TIMEOUT)
+    with handoff_lock:
+        if successor_conn is not None:
+            successor_conn.close()
+    print("Handed over to the new server; exiting")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""Throughput and memory benchmark for file uploads and downloads.
+
+Starts the chat server's HTTP side in-process on an ephemeral port,
+uploads an N-MB file through /api/upload, downloads it again from
+/api/files/<id>, and prints the throughput of each direction and the
+peak RSS of the process. Both ends stream in CHUNK_SIZE pieces, so peak
+RSS should stay flat as --size grows.
+
+Run it from the repository root:
+
+    python benchmark_transfer.py --size 1024
+"""
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+try:
+    import resource  # Peak RSS on Unix-like systems
+except ImportError:
+    resource = None
+
+SERVER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "2303124.py")
+
+def load_server():
+    """Import the chat server module from its file"""
+    spec = importlib.util.spec_from_file_location("chat_server", SERVER_FILE)
+    chat = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(chat)
+    return chat
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def format_rss(rss):
+    return "unknown" if rss is None else f"{rss:.1f} MB"
+
+def make_file(path, size, chunk_size):
+    """Write size bytes of random data without holding them in memory"""
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            count = min(chunk_size, remaining)
+            f.write(os.urandom(count))
+            remaining -= count
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure upload/download throughput and peak memory")
+    parser.add_argument("--size", type=int, default=256, help="file size in MB")
+    args = parser.parse_args()
+
+    chat = load_server()
+    chat.ChatHandler.log_message = lambda *a: None
+    chat.print = lambda *a, **k: None
+
+    with tempfile.TemporaryDirectory() as workdir:
+        chat.UPLOAD_DIR = os.path.join(workdir, "uploads")
+        size = args.size * 1024 * 1024
+        source = os.path.join(workdir, "source.bin")
+        make_file(source, size, chat.CHUNK_SIZE)
+
+        http_server = chat.create_http_server(chat.create_listener("127.0.0.1", 0))
+        port = http_server.server_address[1]
+        chat.serve_http(http_server)
+
+        rss_before = peak_rss_mb()
+
+        # Upload: http.client streams a file body in blocks
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=chat.HTTP_TIMEOUT)
+        start = time.perf_counter()
+        with open(source, "rb") as body:
+            conn.request("POST", "/api/upload?filename=bench.bin&username=bench", body=body,
+                         headers={"Content-Length": str(size), "Content-Type": "application/octet-stream"})
+            result = json.loads(conn.getresponse().read())
+        upload_time = time.perf_counter() - start
+        conn.close()
+        if result.get("status") != "success":
+            print(f"Upload failed: {result.get('message')}")
+            return 1
+
+        # Download, discarding the bytes as they arrive
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=chat.HTTP_TIMEOUT)
+        start = time.perf_counter()
+        conn.request("GET", f"/api/files/{result['file']['id']}")
+        response = conn.getresponse()
+        received = 0
+        while True:
+            chunk = response.read(chat.CHUNK_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+        download_time = time.perf_counter() - start
+        conn.close()
+
+        http_server.shutdown()
+        http_server.server_close()
+
+    if received != size:
+        print(f"Download returned {received} of {size} bytes")
+        return 1
+
+    print(f"File size: {args.size} MB")
+    print(f"Upload:    {args.size / upload_time:.1f} MB/s ({upload_time:.2f} s)")
+    print(f"Download:  {args.size / download_time:.1f} MB/s ({download_time:.2f} s)")
+    print(f"Peak RSS:  {format_rss(peak_rss_mb())} (before transfers: {format_rss(rss_before)})")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
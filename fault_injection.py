@@ -0,0 +1,147 @@
+"""Fault-injection check for heartbeat reaping.
+
+Connects a crowd of socket peers to an in-process chat server and lets
+some of them go silent: they stay connected but never read or answer a
+ping, like a phone that walked out of WiFi Direct range. Reports the
+cost of a broadcast and the memory traced for client state before and
+after the heartbeat reaper runs, and exits non-zero if the silent peers
+were not reaped or the cost did not recover.
+
+Run it from the repository root:
+
+    python fault_injection.py --peers 200 --silent 0.5
+"""
+import argparse
+import importlib.util
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+SERVER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "2303124.py")
+
+def load_server():
+    """Import the chat server module from its file"""
+    spec = importlib.util.spec_from_file_location("chat_server", SERVER_FILE)
+    chat = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(chat)
+    return chat
+
+def answer_pings(peer, silenced):
+    """Reply to every ping with a pong until silenced is set.
+    
+    After that the peer neither reads nor writes but keeps the connection
+    open, which is what the server sees when a phone leaves radio range.
+    """
+    buffer = b""
+    while not silenced.is_set():
+        try:
+            data = peer.recv(4096)
+        except OSError:
+            return
+        if not data:
+            return
+        *lines, buffer = (buffer + data).split(b"\n")
+        for line in lines:
+            if b'"ping"' in line:
+                try:
+                    peer.sendall(b'{"type": "pong"}\n')
+                except OSError:
+                    return
+
+def time_broadcasts(chat, count):
+    """Average milliseconds per broadcast_message() call"""
+    message = json.dumps({"username": "probe", "message": "x" * 200, "timestamp": "00:00:00"})
+    start = time.perf_counter()
+    for _ in range(count):
+        chat.broadcast_message(message)
+    return (time.perf_counter() - start) / count * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Drop socket peers silently and check that they are reaped")
+    parser.add_argument("--peers", type=int, default=200, help="socket peers to connect")
+    parser.add_argument("--silent", type=float, default=0.5, help="fraction of peers that go silent")
+    parser.add_argument("--interval", type=float, default=0.5, help="heartbeat interval in seconds")
+    parser.add_argument("--timeout", type=float, default=1.5, help="heartbeat timeout in seconds")
+    parser.add_argument("--broadcasts", type=int, default=50, help="broadcasts timed per measurement")
+    args = parser.parse_args()
+
+    chat = load_server()
+    chat.HEARTBEAT_INTERVAL = args.interval
+    chat.HEARTBEAT_TIMEOUT = args.timeout
+    chat.print = lambda *a, **k: None  # One line per connection is too noisy here
+
+    listener = chat.create_listener("127.0.0.1", 0)
+    port = listener.getsockname()[1]
+    for target, target_args in ((chat.start_socket_server, (listener,)), (chat.heartbeat_loop, ())):
+        thread = threading.Thread(target=target, args=target_args)
+        thread.daemon = True
+        thread.start()
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    # Every peer answers pings until all are connected; the small accept
+    # backlog makes connecting a few hundred peers take a while
+    silent_count = int(args.peers * args.silent)
+    silenced, never = threading.Event(), threading.Event()
+    live, silent = [], []
+    for i in range(args.peers):
+        peer = socket.create_connection(("127.0.0.1", port))
+        (silent if i < silent_count else live).append(peer)
+        thread = threading.Thread(target=answer_pings, args=(peer, silenced if i < silent_count else never))
+        thread.daemon = True
+        thread.start()
+
+    deadline = time.monotonic() + 60
+    while len(chat.connected_clients) < args.peers and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if len(chat.connected_clients) < args.peers:
+        print(f"FAIL: only {len(chat.connected_clients)} of {args.peers} peers connected")
+        return 1
+
+    before_clients = len(chat.connected_clients)
+    before_cost = time_broadcasts(chat, args.broadcasts)
+    before_memory = tracemalloc.get_traced_memory()[0] - baseline
+    print(f"Before reaping: {before_clients} clients, {before_cost:.3f} ms/broadcast, "
+          f"{before_memory / 1024:.1f} KiB traced")
+
+    # Drop the silent peers, then wait for the reaper: silence for the
+    # timeout, then up to two more ticks
+    silenced.set()
+    time.sleep(args.timeout + 2 * args.interval + 0.5)
+
+    after_clients = len(chat.connected_clients)
+    after_cost = time_broadcasts(chat, args.broadcasts)
+    after_memory = tracemalloc.get_traced_memory()[0] - baseline
+    print(f"After reaping:  {after_clients} clients, {after_cost:.3f} ms/broadcast, "
+          f"{after_memory / 1024:.1f} KiB traced")
+    print(f"Counters: {chat.connection_stats}")
+
+    tracemalloc.stop()
+    for peer in live + silent:
+        peer.close()
+
+    failures = []
+    if after_clients != len(live):
+        failures.append(f"expected {len(live)} clients after reaping, found {after_clients}")
+    if chat.connection_stats["reaped"] < len(silent):
+        failures.append(f"expected {len(silent)} reaped, counted {chat.connection_stats['reaped']}")
+    if len(chat.client_last_seen) != after_clients:
+        failures.append(f"{len(chat.client_last_seen)} last-seen entries left for {after_clients} clients")
+    if silent and after_cost >= before_cost:
+        failures.append("broadcast cost did not drop after reaping")
+    if silent and after_memory >= before_memory:
+        failures.append("traced memory did not drop after reaping")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print("OK: silent peers were reaped and broadcast cost and memory recovered")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())